@@ -1,13 +1,29 @@
 #!/usr/bin/env python3
 import numpy as np
-import numpy.random as rn
 from scipy import sparse as sp
 
-from keras import backend as kb
+import tensorflow as tf
+
 import keras.models as km
 import keras.layers as kl
 import keras.regularizers as kr
-import sklearn.feature_extraction.image as sf
+import keras.optimizers as ko
+import keras.mixed_precision as kmp
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+
+if njit is not None:
+
+    @njit(parallel=True, cache=True)
+    def _gather_patches(X, h, w, vstep, hstep, out):
+        """Copy patches centered at (h, w) from X into out, in parallel."""
+        for n in prange(h.size):
+            out[n, :, :, 0] = X[h[n] - vstep:h[n] + vstep + 1,
+                                w[n] - hstep:w[n] + hstep + 1]
 
 
 class MRAIConvolutionalNeuralNetwork(object):
@@ -22,7 +38,8 @@ class MRAIConvolutionalNeuralNetwork(object):
     def __init__(self, patch_size=(31, 31), classes=[1, 2, 3], num_draw=10,
                  num_kernels=[8], kernel_size=[(3, 3)], dense_size=[16, 8],
                  strides=(1, 1), dropout=0.1, l2=0.001, margin=1,
-                 optimizer='rmsprop', batch_size=32, num_epochs=1):
+                 optimizer='rmsprop', batch_size=32, num_epochs=1,
+                 jit_compile=True, mixed_precision=False, seed=None):
         """
         Initialize with shape, architecture and optimization parameters.
 
@@ -54,9 +71,20 @@ class MRAIConvolutionalNeuralNetwork(object):
             Parameter controlling how far apart dissimilar pairs should be.
         optimizer : str
             Type of optimizer to use for backpropagation.
+        batch_size : int
+            Number of pairs per training step, and of patches fed forward at
+            once.
         num_epochs : int
             Number of times the whole dataset is visited during stochastic
             gradient descent.
+        jit_compile : bool
+            Whether to compile training steps with XLA, fusing the network's
+            operations into fewer kernels.
+        mixed_precision : bool
+            Whether to compute the network in float16 while keeping weights in
+            float32, which lets GPUs with Tensor Cores compute faster.
+        seed : int
+            Seed for the random number generator used in sampling patches.
 
         Returns
         -------
@@ -93,69 +121,103 @@ class MRAIConvolutionalNeuralNetwork(object):
         self.optimizer = optimizer
         self.batch_size = batch_size
         self.num_epochs = num_epochs
+        self.jit_compile = jit_compile
+        self.mixed_precision = mixed_precision
+
+        # Random number generator for sampling patches
+        self.rng = np.random.default_rng(seed)
 
         # Initialize net architecture
-        self.net = self.compile_net()
+        self.embedding_model, self.net = self.compile_net()
 
     def compile_net(self):
-        """Compile network architecture."""
-        # Setup input layers
+        """
+        Compile network architecture.
+
+        Returns
+        -------
+        tower : keras.Model
+            Single tower mapping patches and scanner identifications to the
+            embedding.
+        model : keras.Model
+            Siamese network mapping a pool of patches and pairs within it to
+            the concatenated embeddings of both patches of each pair, compiled
+            with the contrastive loss.
+
+        """
+        # Compute in float16 with float32 weights, if mixed precision is used
+        policy = 'mixed_float16' if self.mixed_precision else 'float32'
+
+        # Setup input layers of a single tower
         A = kl.Input(shape=(*self.patch_size, 1))
-        B = kl.Input(shape=(*self.patch_size, 1))
         sIDA = kl.Input(shape=(1,))
-        sIDB = kl.Input(shape=(1,))
 
         # Convolutional pipeline
-        pipeC = km.Sequential()
-        pipeC.add(kl.Conv2D(self.num_kernels[0],
-                            self.kernel_size[0],
-                            activation='relu',
-                            padding='valid',
-                            kernel_regularizer=kr.l2(self.l2),
-                            input_shape=(*self.patch_size, 1)))
-        pipeC.add(kl.MaxPooling2D(pool_size=(2, 2), padding='valid'))
-        pipeC.add(kl.Dropout(self.dropout))
-        for n in range(1, len(self.num_kernels)):
-            pipeC.add(kl.Conv2D(self.num_kernels[n],
-                                self.kernel_size[n],
-                                activation='relu',
-                                padding='valid',
-                                kernel_regularizer=kr.l2(self.l2)))
-            pipeC.add(kl.MaxPooling2D(pool_size=(2, 2), padding='valid'))
-            pipeC.add(kl.Dropout(self.dropout))
-        pipeC.add(kl.Flatten())
-
-        # Dense pipeline
-        pipeD = km.Sequential()
-        pipeD.add(kl.Dense(self.dense_size[0],
-                           activation='relu',
-                           kernel_regularizer=kr.l2(self.l2),
-                           input_shape=(pipeC.output_shape[1] + 1,)))
+        x = A
+        for n in range(len(self.num_kernels)):
+            x = kl.Conv2D(self.num_kernels[n],
+                          self.kernel_size[n],
+                          activation='relu',
+                          padding='valid',
+                          kernel_regularizer=kr.l2(self.l2),
+                          dtype=policy)(x)
+            x = kl.MaxPooling2D(pool_size=(2, 2), padding='valid',
+                                dtype=policy)(x)
+            x = kl.Dropout(self.dropout, dtype=policy)(x)
+        x = kl.Flatten(dtype=policy)(x)
+
+        # Dense pipeline on convolutional features and scanner identification
+        x = kl.concatenate([x, sIDA], dtype=policy)
+        x = kl.Dense(self.dense_size[0],
+                     activation='relu',
+                     kernel_regularizer=kr.l2(self.l2),
+                     dtype=policy)(x)
         for n in range(1, len(self.dense_size)):
-            pipeD.add(kl.Dropout(self.dropout))
-            pipeD.add(kl.Dense(self.dense_size[n],
-                               activation='relu',
-                               kernel_regularizer=kr.l2(self.l2)))
-        pipeD.add(kl.Dense(2))
+            x = kl.Dropout(self.dropout, dtype=policy)(x)
+            x = kl.Dense(self.dense_size[n],
+                         activation='relu',
+                         kernel_regularizer=kr.l2(self.l2),
+                         dtype=policy)(x)
+
+        # Output embedding in float32 for a numerically stable loss
+        x = kl.Dense(2, dtype='float32')(x)
+
+        # Single-tower model for mapping patches to the embedding
+        tower = km.Model(inputs=[A, sIDA], outputs=x, name='embedding')
+
+        # Setup input layers for a pool of patches and pairs drawn from it
+        P = kl.Input(shape=(*self.patch_size, 1))
+        sID = kl.Input(shape=(1,))
+        iA = kl.Input(shape=(), dtype='int32')
+        iB = kl.Input(shape=(), dtype='int32')
 
-        # Distance in embedding space
-        distance = kl.Lambda(self.l1_norm, output_shape=(1,))(
-                          [pipeD(kl.concatenate([pipeC(A), sIDA])),
-                           pipeD(kl.concatenate([pipeC(B), sIDB]))])
+        # Embed every patch in the pool once, with shared weights
+        E = tower([P, sID])
 
-        # Set model
-        model = km.Model(inputs=[A, B, sIDA, sIDB], outputs=distance)
+        # Embeddings of both patches of each pair
+        eA = kl.Lambda(self.gather_rows, output_shape=(2,))([E, iA])
+        eB = kl.Lambda(self.gather_rows, output_shape=(2,))([E, iB])
+
+        # Set model, distances are computed in the loss
+        model = km.Model(inputs=[P, sID, iA, iB],
+                         outputs=kl.concatenate([eA, eB]))
+
+        # Scale loss to keep float16 gradients from underflowing
+        optimizer = self.optimizer
+        if self.mixed_precision:
+            optimizer = kmp.LossScaleOptimizer(ko.get(optimizer))
 
         # Compile model with optimizer
-        model.compile(loss=self.contrastive_loss, optimizer=self.optimizer)
+        model.compile(loss=self.contrastive_loss, optimizer=optimizer,
+                      jit_compile=self.jit_compile)
 
         # Print model
         print(model.summary())
 
-        # Return compiled model
-        return model
+        # Return single tower and compiled model
+        return tower, model
 
-    def contrastive_loss(self, label, distance):
+    def contrastive_loss(self, label, embeddings):
         """
         Contrastive Siamese loss.
 
@@ -167,8 +229,9 @@ class MRAIConvolutionalNeuralNetwork(object):
         ----------
         label : int
             Similarity label, 1=similar and 0=dissimilar
-        distance: float
-            Lp-norm between pairs of patches mapped through the network.
+        embeddings : array
+            Concatenated embeddings of both patches of a pair, mapped through
+            the network.
 
         Returns
         -------
@@ -176,20 +239,29 @@ class MRAIConvolutionalNeuralNetwork(object):
             Loss value for current pair of patches.
 
         """
-        return kb.sum(label * kb.square(distance) +
-                      (1-label) * kb.maximum(self.margin - distance, 0))
+        # l1-distance between the embeddings of both patches, in float32
+        embeddings = tf.cast(embeddings, tf.float32)
+        distance = self.l1_norm(tf.split(embeddings, 2, axis=1))
+
+        return tf.reduce_sum(label * tf.square(distance) +
+                             (1-label) * tf.maximum(self.margin - distance, 0))
 
     def l1_norm(self, x):
         """l1-norm for loss layer."""
-        return kb.sum(kb.abs(x[0] - x[1]), axis=1, keepdims=True)
+        return tf.reduce_sum(tf.abs(x[0] - x[1]), axis=1, keepdims=True)
 
     def l2_norm(self, x):
         """l2-norm for loss layer."""
-        return kb.sum(kb.square(x[0] - x[1]), axis=1, keepdims=True)
+        return tf.reduce_sum(tf.square(x[0] - x[1]), axis=1, keepdims=True)
+
+    def gather_rows(self, x):
+        """Gather rows of embeddings for pair layer."""
+        return tf.gather(x[0], x[1])
 
     def gen_index_combs(self, x):
         """Generate combinations of two index arrays."""
-        return np.array(np.meshgrid(x[0], x[1])).T.reshape(-1, 2)
+        a, b = np.asarray(x[0]), np.asarray(x[1])
+        return np.column_stack((np.repeat(a, b.size), np.tile(b, a.size)))
 
     def matrix2sparse(self, X, edge=(0, 0), remove_nans=False):
         """
@@ -219,12 +291,12 @@ class MRAIConvolutionalNeuralNetwork(object):
         # Remove edges from array
         X = X[edge[0]:h-edge[0], edge[1]:w-edge[1]]
 
-        # Generate meshgrid of coordinates
-        tx, ty = np.meshgrid(np.arange(edge[0], h-edge[0]),
-                             np.arange(edge[1], w-edge[1]))
+        # Generate grid of coordinates
+        tx, ty = np.indices(X.shape)
 
-        # Reshape and stack index and value arrays
-        sX = np.vstack((tx.T.ravel(), ty.T.ravel(), X.ravel())).T
+        # Stack index and value arrays
+        sX = np.column_stack((tx.ravel() + edge[0], ty.ravel() + edge[1],
+                              X.ravel()))
 
         # Remove rows containing NaN's
         if remove_nans:
@@ -232,6 +304,34 @@ class MRAIConvolutionalNeuralNetwork(object):
 
         return sX
 
+    def class_index(self, Y, edge=(0, 0)):
+        """
+        Map label image to arrays of pixel indices per tissue class.
+
+        Parameters
+        ----------
+        Y : array
+            Label image, may contain NaN's.
+        edge : tuple(int, int)
+            Dimensions of edge to ignore.
+
+        Returns
+        -------
+        dict
+            Maps each tissue class to an array whose rows consist of the row
+            and column index of a pixel of that tissue.
+
+        """
+        # Shape
+        h, w = Y.shape
+
+        # Remove edges from array
+        Y = Y[edge[0]:h-edge[0], edge[1]:w-edge[1]]
+
+        # Find pixels of each tissue, in coordinates of the full image
+        return {c: (np.argwhere(Y == c) + edge).astype(np.int32)
+                for c in self.classes}
+
     def subsample_rows(self, X, num_draw=1):
         """
         Take a random subsample of rows from X.
@@ -258,14 +358,12 @@ class MRAIConvolutionalNeuralNetwork(object):
         if (num_draw > N):
             raise ValueError('Number of samples to draw larger than array.')
 
-        # Generate row range
-        range_rows = np.arange(N)
-
-        # Subsample from range
-        index = rn.choice(range_rows, size=num_draw, replace=False)
-
         # Return selected rows
-        return X[index, :]
+        return X[self.draw_rows(N, num_draw), :]
+
+    def draw_rows(self, n, k):
+        """Draw k distinct row indices out of n."""
+        return self.rng.choice(n, size=k, replace=False, shuffle=False)
 
     def index2patch(self, X, index):
         """
@@ -297,13 +395,8 @@ class MRAIConvolutionalNeuralNetwork(object):
 
         if len(index.shape) == 1:
 
-            # Width and height indices
-            w = np.zeros((num_samples,), dtype='uint8')
-            h = np.zeros((num_samples,), dtype='uint8')
-
-            # For every index, find its multilinear index
-            for n in range(num_samples):
-                w[n], h[n] = np.unravel_index(index[n], X.shape)
+            # Map linear indices to row and column indices
+            h, w = np.unravel_index(index, X.shape)
 
         elif len(index.shape) == 2:
 
@@ -314,13 +407,35 @@ class MRAIConvolutionalNeuralNetwork(object):
         else:
             raise ValueError('Index has wrong shape.')
 
+        # Cast to index type to avoid overflow on large images
+        h = np.asarray(h, dtype=np.intp)
+        w = np.asarray(w, dtype=np.intp)
+
+        # Check whether patches lie within the image
+        if num_samples > 0 and (
+                (h.min() < vstep) or (h.max() >= X.shape[0] - vstep) or
+                (w.min() < hstep) or (w.max() >= X.shape[1] - hstep)):
+            raise ValueError('Patches exceed image borders.')
+
         # Preallocate patch array
-        patches = np.zeros((num_samples, *self.patch_size, 1))
+        patches = np.empty((num_samples, *self.patch_size, 1),
+                           dtype=np.float32)
+
+        # Slice out patches in parallel if numba is available
+        if njit is not None:
+            _gather_patches(X, h, w, vstep, hstep, patches)
+            return patches
+
+        # Row and column offsets from patch center
+        dh = np.arange(-vstep, vstep + 1)
+        dw = np.arange(-hstep, hstep + 1)
 
-        # For each index, slice out subpatch
-        for n in range(num_samples):
-            patches[n, :, :, 0] = X[h[n] - vstep:h[n] + vstep + 1,
-                                    w[n] - hstep:w[n] + hstep + 1]
+        # Broadcast to row and column indices of every patch pixel
+        rr = h[:, None, None] + dh[None, :, None]
+        cc = w[:, None, None] + dw[None, None, :]
+
+        # Slice out all patches in a single gather
+        patches[:, :, :, 0] = X[rr, cc]
 
         return patches
 
@@ -343,8 +458,7 @@ class MRAIConvolutionalNeuralNetwork(object):
             Tissue label array corresponding to patches array.
 
         """
-        # Shapes
-        h, w = X.shape[1:3]
+        # Number of images
         num_images = X.shape[0]
 
         # Number of patches
@@ -355,7 +469,8 @@ class MRAIConvolutionalNeuralNetwork(object):
         hstep = int((self.patch_size[1] - 1)/2)
 
         # Preallocate input and output patches
-        patches = np.zeros((num_patches, *self.patch_size, 1))
+        patches = np.empty((num_patches, *self.patch_size, 1),
+                           dtype=np.float32)
         labels = np.zeros((num_patches,), dtype='int64')
 
         # Define counter
@@ -364,18 +479,15 @@ class MRAIConvolutionalNeuralNetwork(object):
         # Loop over number of images
         for i in range(num_images):
 
+            # Find tissue in image, without patch edges
+            Yi = self.class_index(Y[i], edge=(vstep, hstep))
+
             # Loop over classes
             for k, classk in enumerate(self.classes):
 
-                # Cut patch edges from image
-                Yi = Y[i][vstep:h-vstep, hstep:w-hstep]
-
-                # Find tissue in image
-                Yi_k = np.argwhere(Yi == classk) + (vstep, hstep)
-
                 # Subsample indices
-                Yi_k = rn.choice(np.ravel_multi_index(Yi_k.T, (h, w)),
-                                 size=self.num_draw, replace=False)
+                Yi_k = Yi[classk][self.draw_rows(Yi[classk].shape[0],
+                                                 self.num_draw)]
 
                 # Current patch index
                 ix = range(cnt*self.num_draw, (cnt+1)*self.num_draw)
@@ -384,238 +496,272 @@ class MRAIConvolutionalNeuralNetwork(object):
                 patches[ix, :, :, :] = self.index2patch(X[i], Yi_k)
 
                 # Store class labels
-                labels[ix] = classk*np.ones((self.num_draw,))
+                labels[ix] = classk
 
                 # Tick up
                 cnt += 1
 
         return patches, labels
 
-    def sample_pairs(self, X, y, Z, u, num_draw=(10, 1)):
+    def sample_pool(self, X, y, Z, u, num_draw=(10, 1)):
         """
-        Sample a set of pairs of patches from two images.
+        Sample a pool of patches from two images and pairs within the pool.
 
         Parameters
         ----------
         X : array
             slice from source MRI-scanner
-        y : array
-            source tissue index sparse array; where each row i,j,k consists of
-            the pixel's row index i, the pixel's column index j and the pixel's
-            tissue k.
+        y : dict
+            source tissue index; maps each tissue class to an array whose rows
+            consist of the row and column index of a pixel of that tissue.
         Z : array
             slice from target MRI-scanner
-        u : array
-            target tissue index sparse array; where each row i,j,k consists of
-            the pixel's row index i, the pixel's column index j and the pixel's
-            tissue k.
+        u : dict
+            target tissue index; maps each tissue class to an array whose rows
+            consist of the row and column index of a pixel of that tissue.
         num_draw : tuple(int, int)
             maximum number of patches to draw from (source, target)
 
         Returns
         -------
-        P : list[A, B, a, b]
-            contains pairs of patches and scanner identifications
+        pool : array
+            contains sampled patches from both images
+        scanner : array
+            contains scanner identifications of pooled patches
+        combs : array
+            contains pairs of positions in the pool
         S : array
             contains similarity labels between pairs
 
         """
-        # Check if max draw does not exceed the number of supplied labels
-        if (num_draw[0] > y.shape[0]) or (num_draw[1] > u.shape[0]):
-            raise ValueError('Insufficient labels provided.')
-
         # Take only classes present in current slices
-        classes = np.intersect1d(np.unique(y[:, 2]), np.unique(u[:, 2]))
-        num_classes = len(classes)
-
-        # Number of combinations per set of labels
-        num_combs_yy = num_draw[0]**2
-        num_combs_yu = num_draw[0]*num_draw[1]
-        num_combs_uu = num_draw[1]**2
-
-        # Total number of patches to draw
-        total_num_draw = (num_combs_yy * num_classes*(num_classes - 1) +
-                          num_combs_yu * num_classes*(num_classes - 1) +
-                          num_combs_uu * num_classes*(num_classes - 1))
-
-        # Preallocate patch arrays
-        A = np.zeros((total_num_draw, *self.patch_size, 1))
-        B = np.zeros((total_num_draw, *self.patch_size, 1))
-
-        # Preallocate scanner label vectors
-        a = np.zeros((total_num_draw, 1))
-        b = np.zeros((total_num_draw, 1))
-
-        # Preallocate similarity label array
-        S = np.zeros((total_num_draw, 1))
-
-        # Counter
-        cnt = 0
-
-        # Loop over classes
-        for k, classk in enumerate(classes):
-
-            # Take indices of current tissue
-            index_yk = y[y[:, 2] == classk, :2].astype('uint8')
-            index_uk = u[u[:, 2] == classk, :2].astype('uint8')
+        classes = self.shared_classes(y, u)
 
-            # Subsample from index range
-            index_yk = self.subsample_rows(index_yk, num_draw=num_draw[0])
-            index_uk = self.subsample_rows(index_uk, num_draw=num_draw[1])
+        # Subsample pixels of each class, stacked by class
+        index_y = np.reshape([self.subsample_rows(y[c], num_draw=num_draw[0])
+                              for c in classes], (-1, 2))
+        index_u = np.reshape([self.subsample_rows(u[c], num_draw=num_draw[1])
+                              for c in classes], (-1, 2))
 
-            # Map multilinear index to linear index
-            index_yk = np.ravel_multi_index(index_yk.T, X.shape)
-            index_uk = np.ravel_multi_index(index_uk.T, Z.shape)
+        # Extract sampled patches from both images into a single pool
+        pool = np.concatenate((self.index2patch(X, index_y),
+                               self.index2patch(Z, index_u)))
 
-            ''' Similar pairs from same source image '''
+        # Number of patches drawn from each image
+        num_y = len(classes)*num_draw[0]
+        num_u = len(classes)*num_draw[1]
 
-            # Generate pairwise index combinations
-            combs = self.gen_index_combs((index_yk, index_yk))
+        # Scanner identification (X=0, Z=1) and class of each pooled patch
+        scanner = np.repeat(np.array([0, 1], dtype=np.float32), [num_y, num_u])
+        tissue = np.concatenate((np.repeat(classes, num_draw[0]),
+                                 np.repeat(classes, num_draw[1])))
 
-            # Create current patch index pointer
-            ix = slice(cnt*num_combs_yy, (cnt+1)*num_combs_yy)
+        # Pool positions of source and target patches
+        pos_y = np.arange(num_y)
+        pos_u = np.arange(num_u) + num_y
 
-            # Extract patches and store in arrays
-            A[ix, :, :, :] = self.index2patch(X, combs[:, 0])
-            B[ix, :, :, :] = self.index2patch(X, combs[:, 1])
+        # Pairs within source, between source and target, within target
+        combs = np.concatenate((self.gen_index_combs((pos_y, pos_y)),
+                                self.gen_index_combs((pos_y, pos_u)),
+                                self.gen_index_combs((pos_u, pos_u))))
 
-            # Store scanner identifications of patches (X=0, Z=1)
-            a[ix, :] = np.zeros((num_combs_yy, 1))
-            b[ix, :] = np.zeros((num_combs_yy, 1))
+        # Mark pairs of the same tissue as similar(=1), else dissimilar(=0)
+        S = (tissue[combs[:, 0]] == tissue[combs[:, 1]])[:, None]
+        S = S.astype(np.float32)
 
-            # Mark these combinations as similar(=1)
-            S[ix, :] = np.ones((num_combs_yy, 1))
+        return pool, scanner[:, None], combs, S
 
-            # Increment counter
-            cnt += 1
-
-            ''' Similar pairs from source image and target image '''
-
-            # Generate pairwise index combinations
-            combs = self.gen_index_combs((index_yk, index_uk))
+    def sample_pairs(self, X, y, Z, u, num_draw=(10, 1)):
+        """
+        Sample a set of pairs of patches from two images.
 
-            # Create current patch index pointer
-            ix = slice(cnt*num_combs_yu, (cnt+1)*num_combs_yu)
+        Parameters
+        ----------
+        X : array
+            slice from source MRI-scanner
+        y : dict
+            source tissue index; maps each tissue class to an array whose rows
+            consist of the row and column index of a pixel of that tissue.
+        Z : array
+            slice from target MRI-scanner
+        u : dict
+            target tissue index; maps each tissue class to an array whose rows
+            consist of the row and column index of a pixel of that tissue.
+        num_draw : tuple(int, int)
+            maximum number of patches to draw from (source, target)
 
-            # Extract patches and store in arrays
-            A[ix, :, :, :] = self.index2patch(X, combs[:, 0])
-            B[ix, :, :, :] = self.index2patch(Z, combs[:, 1])
+        Returns
+        -------
+        P : list[A, B, a, b]
+            contains pairs of patches and scanner identifications
+        S : array
+            contains similarity labels between pairs
 
-            # Store scanner identifications of patches (X=0, Z=1)
-            a[ix, :] = np.zeros((num_combs_yu, 1))
-            b[ix, :] = np.ones((num_combs_yu, 1))
+        """
+        # Sample pool of patches and pairs of pool positions
+        pool, scanner, combs, S = self.sample_pool(X, y, Z, u,
+                                                   num_draw=num_draw)
 
-            # Mark these combinations as similar(=1)
-            S[ix, :] = np.ones((num_combs_yu, 1))
+        # Gather patches and scanner identifications of all pairs
+        A = pool[combs[:, 0]]
+        B = pool[combs[:, 1]]
+        a = scanner[combs[:, 0]]
+        b = scanner[combs[:, 1]]
 
-            # Increment counter
-            cnt += 1
+        # Return collected patches
+        return [A, B, a, b], S
 
-            ''' Similar pairs from same target image '''
+    def shared_classes(self, y, u):
+        """Tissue classes with pixels in both tissue indices."""
+        return [c for c in y if (c in u) and
+                (y[c].shape[0] > 0) and (u[c].shape[0] > 0)]
 
-            # Generate pairwise index combinations
-            combs = self.gen_index_combs((index_uk, index_uk))
+    def pair_draws(self, X, Y, Z, U, num_targets=1):
+        """
+        List the pairs of images to draw pools of patches from.
 
-            # Create current patch index pointer
-            ix = slice(cnt*num_combs_uu, (cnt+1)*num_combs_uu)
+        Each source image is paired with every target image and, if there are
+        multiple source subjects, with one random other source image.
 
-            # Extract patches and store in arrays
-            A[ix, :, :, :] = self.index2patch(Z, combs[:, 0])
-            B[ix, :, :, :] = self.index2patch(Z, combs[:, 1])
+        Parameters
+        ----------
+        X : array
+            source scans, slices by height by width
+        Y : array
+            source labels, slices by height by width
+        Z : array
+            target scans, slices by height by width
+        U : array
+            target labels, slices by height by width,
+            contains NaN's at unknown labels
+        num_targets : int
+            How many target labels to use.
 
-            # Store scanner identifications of patches (X=0, Z=1)
-            a[ix, :] = np.ones((num_combs_uu, 1))
-            b[ix, :] = np.ones((num_combs_uu, 1))
+        Returns
+        -------
+        draws : list[tuple(X, y, Z, u, num_draw)]
+            source image with its tissue index, second image with its tissue
+            index, and number of patches to draw from (source, second image)
 
-            # Mark these combinations as similar(=1)
-            S[ix, :] = np.ones((num_combs_uu, 1))
+        """
+        # Number of subjects from each scanner
+        num_src_sub = X.shape[0]
+        num_tgt_sub = Z.shape[0]
 
-            # Increment counter
-            cnt += 1
+        # Ignore pixels whose patches would exceed the image
+        edge = (int((self.patch_size[0] - 1)/2),
+                int((self.patch_size[1] - 1)/2))
 
-            # Loop over other classes
-            for l, classl in enumerate(np.setdiff1d(classk, classes)):
+        # Index tissue pixels of all label images
+        Ys = [self.class_index(Y[i], edge=edge) for i in range(num_src_sub)]
+        Us = [self.class_index(U[j], edge=edge) for j in range(num_tgt_sub)]
 
-                # Take indices of current tissue
-                index_yl = y[y[:, 2] == classl, :1].astype('uint8')
-                index_ul = u[u[:, 2] == classl, :1].astype('uint8')
+        draws = []
+        for i in range(num_src_sub):
 
-                # Subsample indices
-                index_yl = self.subsample_rows(index_yl, num_draw=num_draw[0])
-                index_ul = self.subsample_rows(index_ul, num_draw=num_draw[1])
+            # Draw pairs with every target image
+            draws += [(X[i], Ys[i], Z[j], Us[j], (self.num_draw, num_targets))
+                      for j in range(num_tgt_sub)]
 
-                # Map multilinear index to linear index
-                index_yk = np.ravel_multi_index(index_yl.T, X.shape)
-                index_uk = np.ravel_multi_index(index_ul.T, Z.shape)
+            # Check for multiple source subjects
+            if num_src_sub > 1:
 
-                ''' Dissimilar pairs from same source image '''
+                # Take random other source image
+                o = self.rng.choice(np.setdiff1d(np.arange(num_src_sub), i))
 
-                # Generate pairwise index combinations
-                combs = self.gen_index_combs((index_yk, index_yl))
+                # Draw pairs with other source image
+                draws.append((X[i], Ys[i], X[o], Ys[o],
+                              (self.num_draw, self.num_draw)))
 
-                # Create current patch index pointer
-                ix = slice(cnt*num_combs_yy, (cnt+1)*num_combs_yy)
+        return draws
 
-                # Extract patches and store in arrays
-                A[ix, :, :, :] = self.index2patch(X, combs[:, 0])
-                B[ix, :, :, :] = self.index2patch(X, combs[:, 1])
+    def num_pair_batches(self, draws):
+        """Number of batches iter_pair_batches yields for a list of draws."""
+        num_batches = 0
+        for X, y, Z, u, num_draw in draws:
 
-                # Store scanner identifications of patches (X=0, Z=1)
-                a[ix, :] = np.zeros((num_combs_yy, 1))
-                b[ix, :] = np.zeros((num_combs_yy, 1))
+            # Number of patches drawn from each image
+            num_classes = len(self.shared_classes(y, u))
+            num_y = num_classes*num_draw[0]
+            num_u = num_classes*num_draw[1]
 
-                # Mark these combinations as dissimilar(=0)
-                S[ix, :] = np.zeros((num_combs_yy, 1))
+            # Pairs within source, between source and target, within target
+            num_pairs = num_y*num_y + num_y*num_u + num_u*num_u
 
-                # Increment counter
-                cnt += 1
+            num_batches += int(np.ceil(num_pairs / self.batch_size))
 
-                ''' Dissimilar pairs from source image and target image '''
+        return num_batches
 
-                # Generate pairwise index combinations
-                combs = self.gen_index_combs((index_yk, index_ul))
+    def iter_pair_batches(self, draws):
+        """
+        Iterate over shuffled batches of pairs of patches from the images.
 
-                # Create current patch index pointer
-                ix = slice(cnt*num_combs_yu, (cnt+1)*num_combs_yu)
+        Each batch carries the whole pool of patches its pairs were drawn
+        from, so that the tower embeds every pooled patch once per training
+        step instead of once per pair.
 
-                # Extract patches and store in arrays
-                A[ix, :, :, :] = self.index2patch(X, combs[:, 0])
-                B[ix, :, :, :] = self.index2patch(Z, combs[:, 1])
+        Parameters
+        ----------
+        draws : list[tuple(X, y, Z, u, num_draw)]
+            pairs of images to draw pools of patches from, see pair_draws
+
+        Yields
+        ------
+        P : tuple(pool, scanner, iA, iB)
+            pool of patches with their scanner identifications, and batch of
+            pairs as positions of both patches in the pool
+        S : array
+            batch of similarity labels between pairs
 
-                # Store scanner identifications of patches (X=0, Z=1)
-                a[ix, :] = np.zeros((num_combs_yu, 1))
-                b[ix, :] = np.ones((num_combs_yu, 1))
+        """
+        for X, y, Z, u, num_draw in draws:
 
-                # Mark these combinations as dissimilar(=0)
-                S[ix, :] = np.zeros((num_combs_yu, 1))
+            # Draw pool of patches and pairs from two images
+            pool, scanner, combs, S = self.sample_pool(X, y, Z, u,
+                                                       num_draw=num_draw)
 
-                # Increment counter
-                cnt += 1
+            # Shuffle pairs
+            order = self.rng.permutation(S.shape[0])
 
-                ''' Dissimilar pairs from same target image '''
+            # Yield batches of pairs, each with the pool they index into
+            for n in range(0, S.shape[0], self.batch_size):
+                ix = order[n:n + self.batch_size]
+                yield (pool, scanner,
+                       combs[ix, 0].astype(np.int32),
+                       combs[ix, 1].astype(np.int32)), S[ix]
 
-                # Generate pairwise index combinations
-                combs = self.gen_index_combs((index_uk, index_ul))
+    def pair_dataset(self, draws):
+        """
+        Stream batches of pairs of patches through a prefetched dataset.
 
-                # Create current patch index pointer
-                ix = slice(cnt*num_combs_uu, (cnt+1)*num_combs_uu)
+        Parameters
+        ----------
+        draws : list[tuple(X, y, Z, u, num_draw)]
+            pairs of images to draw pools of patches from, see pair_draws
 
-                # Extract patches and store in arrays
-                A[ix, :, :, :] = self.index2patch(Z, combs[:, 0])
-                B[ix, :, :, :] = self.index2patch(Z, combs[:, 1])
+        Returns
+        -------
+        tf.data.Dataset
+            batches of pairs, as yielded by iter_pair_batches
 
-                # Store scanner identifications of patches (X=0, Z=1)
-                a[ix, :] = np.ones((num_combs_uu, 1))
-                b[ix, :] = np.ones((num_combs_uu, 1))
+        """
+        # Shapes of a pool of patches and a batch of pairs
+        patch_spec = tf.TensorSpec(shape=(None, *self.patch_size, 1),
+                                   dtype=tf.float32)
+        label_spec = tf.TensorSpec(shape=(None, 1), dtype=tf.float32)
+        index_spec = tf.TensorSpec(shape=(None,), dtype=tf.int32)
 
-                # Mark these combinations as dissimilar(=0)
-                S[ix, :] = np.zeros((num_combs_uu, 1))
+        # Sample pairs on the host while the net trains on previous batches
+        pairs = tf.data.Dataset.from_generator(
+            lambda: self.iter_pair_batches(draws),
+            output_signature=((patch_spec, label_spec, index_spec, index_spec),
+                              label_spec))
 
-                # Increment counter
-                cnt += 1
+        # Declare number of batches, so progress and epochs are known
+        pairs = pairs.apply(tf.data.experimental.assert_cardinality(
+            self.num_pair_batches(draws)))
 
-        # Return collected patches
-        return [A, B, a, b], S
+        return pairs.prefetch(tf.data.AUTOTUNE)
 
     def train(self, X, Y, Z, U, num_targets=1):
         """
@@ -640,64 +786,20 @@ class MRAIConvolutionalNeuralNetwork(object):
         None
 
         """
-        # Number of subjects from each scanner
-        num_src_sub = X.shape[0]
-        num_tgt_sub = Z.shape[0]
-
-        # Loop over source images
-        for i in range(num_src_sub):
-            print('At source subject '+str(i+1)+'/'+str(num_src_sub))
+        # Cast scans once to the network's float precision
+        X = X.astype(np.float32, copy=False)
+        Z = Z.astype(np.float32, copy=False)
 
-            # Map source label image to sparse array
-            Yi = self.matrix2sparse(Y[i])
+        # Check number of targets does not exceed number of labels
+        if num_targets > np.prod(U.shape[1:]):
+            raise ValueError('More targets than labels asked.')
 
-            # Loop over target images
-            for j in range(num_tgt_sub):
+        # Pairs of images to draw patches from
+        draws = self.pair_draws(X, Y, Z, U, num_targets=num_targets)
 
-                # Map target label image to sparse array
-                Uj = self.matrix2sparse(U[j])
-
-                # Number of target labels of current image
-                num_labels = Uj.shape[0]
-
-                # Check number of targets does not exceed number of labels
-                if num_targets > num_labels:
-                    raise ValueError('More targets than labels asked.')
-
-                # Draw pairs of patches from two images
-                P, S = self.sample_pairs(X[i], Yi, Z[j], Uj,
-                                         num_draw=(self.num_draw, num_targets))
-
-                # Train on current set
-                self.net.fit(x=P, y=S,
-                             epochs=self.num_epochs,
-                             batch_size=self.batch_size,
-                             validation_split=0.1,
-                             shuffle=True,
-                             verbose=1)
-
-            # Check for multiple source subjects
-            if num_src_sub > 1:
-
-                # Take random other source image
-                o = np.random.choice(np.setdiff1d(np.arange(num_src_sub), i),
-                                     size=1, replace=False)[0]
-
-                # Map target label image to sparse array
-                Yo = self.matrix2sparse(Y[o])
-
-                # Draw pairs of patches from two images
-                P, S = self.sample_pairs(X[i], Yi, X[o], Yo,
-                                         num_draw=(self.num_draw, 
-                                                   self.num_draw))
-
-                # Train on current set
-                self.net.fit(x=P, y=S,
-                             epochs=self.num_epochs,
-                             batch_size=self.batch_size,
-                             validation_split=0.1,
-                             shuffle=True,
-                             verbose=1)
+        # Train on all pairs of images
+        self.net.fit(self.pair_dataset(draws), epochs=self.num_epochs,
+                     verbose=1)
 
         # Report
         print('Training complete.')
@@ -763,6 +865,9 @@ class MRAIConvolutionalNeuralNetwork(object):
         # Load weights into new model
         self.net.load_weights(weights_fn)
 
+        # Single-tower model nested in loaded net
+        self.embedding_model = self.net.get_layer('embedding')
+
         # Report
         print("Loaded model from disk")
 
@@ -793,15 +898,88 @@ class MRAIConvolutionalNeuralNetwork(object):
         # Number of patches
         num_patches = patches.shape[0]
 
-        # Define intermediate-output model
-        interm_model = km.Model(inputs=self.net.input,
-                                outputs=self.net.layers[-2].get_output_at(1))
-
         # Scan ID list
-        sID = scan_ID*np.ones((num_patches, 1))
+        sID = np.full((num_patches, 1), scan_ID)
 
-        # Feed forward
-        return interm_model.predict([patches, patches, sID, sID])
+        # Feed forward through a single tower
+        return self.embedding_model.predict([patches, sID],
+                                            batch_size=self.batch_size)
+
+    def embed_image(self, X, scan_ID):
+        """
+        Map the patch around every pixel of an image to the embedding at once.
+
+        The tower is evaluated as a fully-convolutional network on the whole
+        image: pooling is applied with stride 1 and later layers are dilated
+        accordingly, while the first dense layer becomes a convolution over
+        the features of a patch. Convolutions are thereby shared between
+        overlapping patches, with the same result as feeding each patch.
+
+        The image is always embedded in float32. With mixed precision, the
+        embeddings therefore differ from those of feedforward, which computes
+        in float16, by float16 rounding errors of up to about 1e-2.
+
+        Parameters
+        ----------
+        X : array
+            Image padded by half the patch size on each side.
+        scan_ID : int
+            Scanner identification variable, indicating from which MRI-scanner
+            this image came from.
+
+        Returns
+        -------
+        array
+            Final layer representation of the patch around each pixel, image
+            height by image width by embedding dimensionality.
+
+        """
+        # Shape of unpadded image
+        h = X.shape[0] - self.patch_size[0] + 1
+        w = X.shape[1] - self.patch_size[1] + 1
+
+        # Layers of the tower
+        convs = [l for l in self.embedding_model.layers
+                 if isinstance(l, kl.Conv2D)]
+        pools = [l for l in self.embedding_model.layers
+                 if isinstance(l, kl.MaxPooling2D)]
+        denses = [l for l in self.embedding_model.layers
+                  if isinstance(l, kl.Dense)]
+
+        # Image as a batch of one with one channel
+        x = tf.constant(X[None, :, :, None], dtype=tf.float32)
+
+        # Spatial shape of convolutional features of a single patch
+        fh, fw = self.patch_size
+
+        # Convolutional pipeline, dilated by the pooling strides so far
+        dh, dw = 1, 1
+        for conv, pool in zip(convs, pools):
+            K, c = conv.get_weights()
+            x = conv.activation(tf.nn.conv2d(x, K, strides=1, padding='VALID',
+                                             dilations=(dh, dw)) + c)
+            x = tf.nn.pool(x, window_shape=pool.pool_size, pooling_type='MAX',
+                           padding='VALID', dilations=(dh, dw))
+            fh = (fh - K.shape[0] - pool.pool_size[0] + 1)//pool.strides[0] + 1
+            fw = (fw - K.shape[1] - pool.pool_size[1] + 1)//pool.strides[1] + 1
+            dh *= pool.strides[0]
+            dw *= pool.strides[1]
+
+        # First dense layer as convolution over features of a patch, with the
+        # weights of the scanner identification folded into the bias
+        W, c = denses[0].get_weights()
+        K = W[:-1].reshape((fh, fw, x.shape[-1], W.shape[1]))
+        x = denses[0].activation(tf.nn.conv2d(x, K, strides=1, padding='VALID',
+                                              dilations=(dh, dw)) +
+                                 c + scan_ID*W[-1])
+
+        # Remaining dense layers act on each pixel
+        for dense in denses[1:]:
+            W, c = dense.get_weights()
+            x = dense.activation(tf.tensordot(x, W, axes=1) + c)
+
+        # Crop to one embedding per pixel of unpadded image
+        return x[0, :h, :w, :].numpy()
 
     def segment_image(self, X, model, feed=True, mapost=False, scan_ID=1):
         """
@@ -841,15 +1019,21 @@ class MRAIConvolutionalNeuralNetwork(object):
         X = np.pad(X, pad_width=((vstep, vstep), (hstep, hstep)),
                    mode='constant')
 
-        # Sample patches at grid
-        patches = sf.extract_patches_2d(X, patch_size=self.patch_size)
-
         # Feed through network
         if feed:
-            patches = self.feedforward(patches, scan_ID=scan_ID)
 
-        # Classify embedded patches
-        preds = model.predict(patches)
+            # Classify embedded patches
+            patches = self.embed_image(X, scan_ID=scan_ID)
+            preds = model.predict(patches.reshape((-1, patches.shape[-1])))
+
+        else:
+
+            # Zero-copy view of the patch around every pixel
+            windows = np.lib.stride_tricks.sliding_window_view(
+                X, self.patch_size)
+
+            # Classify patches row by row, copying one row of windows at most
+            preds = np.concatenate([model.predict(row) for row in windows])
 
         # If model outputs posteriors, then take maximum a posteriori
         if mapost:
@@ -270,12 +270,12 @@ class MRAIDenseNeuralNetwork(object):
         if len(index.shape) == 1:
 
             # Width and height indices
-            w = np.zeros((num_samples,), dtype='uint8')
-            h = np.zeros((num_samples,), dtype='uint8')
+            h = np.zeros((num_samples,), dtype=np.int32)
+            w = np.zeros((num_samples,), dtype=np.int32)
 
             # For every index, find its multilinear index
             for n in range(num_samples):
-                w[n], h[n] = np.unravel_index(index[n], X.shape)
+                h[n], w[n] = np.unravel_index(index[n], X.shape)
 
         elif len(index.shape) == 2:
 
@@ -356,7 +356,7 @@ class MRAIDenseNeuralNetwork(object):
                 patches[ix, :, :, :] = self.index2patch(X[i], Yi_k)
 
                 # Store class labels
-                labels[ix] = classk*np.ones((self.num_draw,))
+                labels[ix] = classk
 
                 # Tick up
                 cnt += 1
@@ -428,8 +428,8 @@ class MRAIDenseNeuralNetwork(object):
         for k, classk in enumerate(classes):
 
             # Take indices of current tissue
-            index_yk = y[y[:, 2] == classk, :2].astype('uint8')
-            index_uk = u[u[:, 2] == classk, :2].astype('uint8')
+            index_yk = y[y[:, 2] == classk, :2].astype(np.int32, copy=False)
+            index_uk = u[u[:, 2] == classk, :2].astype(np.int32, copy=False)
 
             # Subsample from index range
             index_yk = self.subsample_rows(index_yk, num_draw=num_draw[0])
@@ -452,11 +452,11 @@ class MRAIDenseNeuralNetwork(object):
             B[ix, :, :, :] = self.index2patch(X, combs[:, 1])
 
             # Store scanner identifications of patches (X=0, Z=1)
-            a[ix, :] = np.zeros((num_combs_yy, 1))
-            b[ix, :] = np.zeros((num_combs_yy, 1))
+            a[ix, :] = 0
+            b[ix, :] = 0
 
             # Mark these combinations as similar(=1)
-            S[ix, :] = np.ones((num_combs_yy, 1))
+            S[ix, :] = 1
 
             # Increment counter
             cnt += 1
@@ -474,11 +474,11 @@ class MRAIDenseNeuralNetwork(object):
             B[ix, :, :, :] = self.index2patch(Z, combs[:, 1])
 
             # Store scanner identifications of patches (X=0, Z=1)
-            a[ix, :] = np.zeros((num_combs_yu, 1))
-            b[ix, :] = np.ones((num_combs_yu, 1))
+            a[ix, :] = 0
+            b[ix, :] = 1
 
             # Mark these combinations as similar(=1)
-            S[ix, :] = np.ones((num_combs_yu, 1))
+            S[ix, :] = 1
 
             # Increment counter
             cnt += 1
@@ -496,11 +496,11 @@ class MRAIDenseNeuralNetwork(object):
             B[ix, :, :, :] = self.index2patch(Z, combs[:, 1])
 
             # Store scanner identifications of patches (X=0, Z=1)
-            a[ix, :] = np.ones((num_combs_uu, 1))
-            b[ix, :] = np.ones((num_combs_uu, 1))
+            a[ix, :] = 1
+            b[ix, :] = 1
 
             # Mark these combinations as similar(=1)
-            S[ix, :] = np.ones((num_combs_uu, 1))
+            S[ix, :] = 1
 
             # Increment counter
             cnt += 1
@@ -509,8 +509,10 @@ class MRAIDenseNeuralNetwork(object):
             for l, classl in enumerate(np.setdiff1d(classk, classes)):
 
                 # Take indices of current tissue
-                index_yl = y[y[:, 2] == classl, :1].astype('uint8')
-                index_ul = u[u[:, 2] == classl, :1].astype('uint8')
+                index_yl = y[y[:, 2] == classl, :1].astype(np.int32,
+                                                           copy=False)
+                index_ul = u[u[:, 2] == classl, :1].astype(np.int32,
+                                                           copy=False)
 
                 # Subsample indices
                 index_yl = self.subsample_rows(index_yl, num_draw=num_draw[0])
@@ -533,11 +535,11 @@ class MRAIDenseNeuralNetwork(object):
                 B[ix, :, :, :] = self.index2patch(X, combs[:, 1])
 
                 # Store scanner identifications of patches (X=0, Z=1)
-                a[ix, :] = np.zeros((num_combs_yy, 1))
-                b[ix, :] = np.zeros((num_combs_yy, 1))
+                a[ix, :] = 0
+                b[ix, :] = 0
 
                 # Mark these combinations as dissimilar(=0)
-                S[ix, :] = np.zeros((num_combs_yy, 1))
+                S[ix, :] = 0
 
                 # Increment counter
                 cnt += 1
@@ -555,11 +557,11 @@ class MRAIDenseNeuralNetwork(object):
                 B[ix, :, :, :] = self.index2patch(Z, combs[:, 1])
 
                 # Store scanner identifications of patches (X=0, Z=1)
-                a[ix, :] = np.zeros((num_combs_yu, 1))
-                b[ix, :] = np.ones((num_combs_yu, 1))
+                a[ix, :] = 0
+                b[ix, :] = 1
 
                 # Mark these combinations as dissimilar(=0)
-                S[ix, :] = np.zeros((num_combs_yu, 1))
+                S[ix, :] = 0
 
                 # Increment counter
                 cnt += 1
@@ -577,11 +579,11 @@ class MRAIDenseNeuralNetwork(object):
                 B[ix, :, :, :] = self.index2patch(Z, combs[:, 1])
 
                 # Store scanner identifications of patches (X=0, Z=1)
-                a[ix, :] = np.ones((num_combs_uu, 1))
-                b[ix, :] = np.ones((num_combs_uu, 1))
+                a[ix, :] = 1
+                b[ix, :] = 1
 
                 # Mark these combinations as dissimilar(=0)
-                S[ix, :] = np.zeros((num_combs_uu, 1))
+                S[ix, :] = 0
 
                 # Increment counter
                 cnt += 1
@@ -770,7 +772,7 @@ class MRAIDenseNeuralNetwork(object):
                                 outputs=self.net.layers[-2].get_output_at(1))
 
         # Scan ID list
-        sID = scan_ID*np.ones((num_patches, 1))
+        sID = np.full((num_patches, 1), scan_ID)
 
         # Feed forward
         return interm_model.predict([patches, patches, sID, sID])
@@ -2,7 +2,10 @@ import pytest
 import numpy as np
 import numpy.random as rn
 import tensorflow as tf
+import keras.layers as kl
+import keras.mixed_precision as kmp
 
+from mrainet import mraicnn
 from mrainet.mraicnn import MRAIConvolutionalNeuralNetwork
 from mrainet.util import extract_all_patches
 
@@ -27,26 +30,37 @@ def test_init_num_kernels():
 
 def test_contrastive_loss():
     """Test non-negative contrastive loss."""
-    N = MRAIConvolutionalNeuralNetwork()
-    with tf.Session().as_default():
-        assert N.contrastive_loss(label=1, distance=rn.randn(1)).eval() >= 0
-        assert N.contrastive_loss(label=0, distance=rn.randn(1)).eval() >= 0
+    N = MRAIConvolutionalNeuralNetwork(margin=1)
+    assert float(N.contrastive_loss(1., rn.randn(1, 4).astype('f4'))) >= 0
+    assert float(N.contrastive_loss(0., rn.randn(1, 4).astype('f4'))) >= 0
+
+    # Similar pairs give squared l1-distance between embeddings
+    far = np.array([[0, 0, 1, 2]], 'f4')
+    near = np.array([[0, 0, .25, .25]], 'f4')
+    assert np.isclose(float(N.contrastive_loss(1., far)), 9.)
+    assert np.isclose(float(N.contrastive_loss(1., near)), .25)
+
+    # Dissimilar pairs give hinge loss, zero past the margin
+    assert np.isclose(float(N.contrastive_loss(0., far)), 0.)
+    assert np.isclose(float(N.contrastive_loss(0., near)), .5)
 
 
 def test_l1_norm():
     """Test non-negative norm."""
     N = MRAIConvolutionalNeuralNetwork()
-    with tf.Session().as_default():
-        norms = N.l1_norm([rn.randn(100, 1), rn.randn(100, 1)]).eval()
-        assert np.all(np.array(norms) >= 0)
+    norms = N.l1_norm([rn.randn(100, 1), rn.randn(100, 1)]).numpy()
+    assert np.all(norms >= 0)
+    norms = N.l1_norm([np.array([[0., 0.]]), np.array([[1., -2.]])]).numpy()
+    assert np.allclose(norms, [[3.]])
 
 
 def test_l2_norm():
     """Test non-negative norm."""
     N = MRAIConvolutionalNeuralNetwork()
-    with tf.Session().as_default():
-        norms = N.l2_norm([rn.randn(100, 1), rn.randn(100, 1)]).eval()
-        assert np.all(np.array(norms) >= 0)
+    norms = N.l2_norm([rn.randn(100, 1), rn.randn(100, 1)]).numpy()
+    assert np.all(norms >= 0)
+    norms = N.l2_norm([np.array([[0., 0.]]), np.array([[1., -2.]])]).numpy()
+    assert np.allclose(norms, [[5.]])
 
 
 def test_gen_index_combs():
@@ -71,6 +85,19 @@ def test_matrix2sparse():
     assert len(np.setdiff1d(sA[:, 2], np.arange(24))) == 0
 
 
+def test_class_index():
+    """Test all tissue pixels are indexed."""
+    A = np.array([[1, 2, 1], [3, np.nan, 2]])
+    N = MRAIConvolutionalNeuralNetwork(classes=[1, 2, 3])
+    iA = N.class_index(A)
+    assert sorted(iA.keys()) == [1, 2, 3]
+    assert np.all(iA[1] == [[0, 0], [0, 2]])
+    assert np.all(iA[2] == [[0, 1], [1, 2]])
+    assert np.all(iA[3] == [[1, 0]])
+    iA = N.class_index(A, edge=(0, 1))
+    assert np.all(iA[2] == [[0, 1]])
+
+
 def test_subsample_rows():
     """Correct shape and contents."""
     A = np.arange(24).reshape((12, 2))
@@ -81,6 +108,44 @@ def test_subsample_rows():
     assert len(np.unique(a) == 5)
 
 
+def test_subsample_rows_seed():
+    """Same seed draws same rows."""
+    A = np.arange(24).reshape((12, 2))
+    a = MRAIConvolutionalNeuralNetwork(seed=1).subsample_rows(A, num_draw=5)
+    b = MRAIConvolutionalNeuralNetwork(seed=1).subsample_rows(A, num_draw=5)
+    assert np.all(a == b)
+
+
+def test_index2patch():
+    """Patches match slices around indices."""
+    N = MRAIConvolutionalNeuralNetwork(patch_size=(5, 7))
+    X = rn.randn(300, 300)
+    index = np.array([[2, 3], [280, 296]])
+    P = N.index2patch(X, index)
+    assert P.shape == (2, 5, 7, 1)
+    assert np.allclose(P[1, :, :, 0], X[278:283, 293:300])
+    L = N.index2patch(X, np.ravel_multi_index(index.T, X.shape))
+    assert np.all(L == P)
+
+
+def test_index2patch_numpy(monkeypatch):
+    """Numpy fallback slices the same patches."""
+    N = MRAIConvolutionalNeuralNetwork(patch_size=(5, 7))
+    X = rn.randn(40, 30)
+    index = np.array([[2, 3], [37, 26], [20, 10]])
+    P = N.index2patch(X, index)
+    monkeypatch.setattr(mraicnn, 'njit', None)
+    assert np.all(N.index2patch(X, index) == P)
+
+
+def test_index2patch_border():
+    """Patches outside image."""
+    N = MRAIConvolutionalNeuralNetwork(patch_size=(5, 7))
+    X = rn.randn(30, 30)
+    with pytest.raises(ValueError):
+        N.index2patch(X, np.array([[1, 15]]))
+
+
 def test_sample_pairs():
     """Produces correct output shape."""
     # Network
@@ -88,17 +153,18 @@ def test_sample_pairs():
                                        num_kernels=[1],
                                        kernel_size=[(2, 2)],
                                        dense_size=[2],
-                                       num_draw=2)
+                                       num_draw=2,
+                                       seed=0)
 
     # Source array
     X = rn.randn(32, 32)
     Y = np.round(np.linspace(0, 3, 32**2)).reshape((32, 32))
-    y = N.matrix2sparse(Y, edge=(4, 4))
+    y = N.class_index(Y, edge=(4, 4))
 
     # Target array
     Z = rn.randn(32, 32)
     U = np.round(np.linspace(0, 3, 32**2)).reshape((32, 32))
-    u = N.matrix2sparse(U, edge=(4, 4))
+    u = N.class_index(U, edge=(4, 4))
 
     # Sample pairs
     P, S = N.sample_pairs(X, y, Z, u, num_draw=(2, 1))
@@ -122,6 +188,95 @@ def test_sample_pairs():
     assert len(np.setdiff1d(np.unique(b), [0, 1])) == 0
     assert len(np.setdiff1d(np.unique(S), [0, 1])) == 0
 
+    # Pairs are gathered from the same draw as sample_pool
+    M = MRAIConvolutionalNeuralNetwork(patch_size=(9, 9),
+                                       num_kernels=[1],
+                                       kernel_size=[(2, 2)],
+                                       dense_size=[2],
+                                       num_draw=2,
+                                       seed=0)
+    pool, scanner, combs, T = M.sample_pool(X, y, Z, u, num_draw=(2, 1))
+    assert np.all(A == pool[combs[:, 0]])
+    assert np.all(B == pool[combs[:, 1]])
+    assert np.all(a == scanner[combs[:, 0]])
+    assert np.all(b == scanner[combs[:, 1]])
+    assert np.all(S == T)
+
+
+def test_sample_pool():
+    """Pairs index into pool of patches."""
+    N = MRAIConvolutionalNeuralNetwork(patch_size=(9, 9),
+                                       num_kernels=[1],
+                                       kernel_size=[(2, 2)],
+                                       dense_size=[2],
+                                       num_draw=2)
+
+    # Images whose pixels are their tissue label, offset by 10 in target
+    Y = np.round(np.linspace(0, 3, 32**2)).reshape((32, 32))
+    y = N.class_index(Y, edge=(4, 4))
+    pool, scanner, combs, S = N.sample_pool(Y, y, Y + 10, y, num_draw=(2, 1))
+
+    # Three classes, two source and one target patch each
+    assert pool.shape[0] == 9
+    assert scanner.shape == (9, 1)
+    assert combs.shape == (63, 2)
+    assert S.shape == (63, 1)
+    assert np.all(combs < pool.shape[0])
+
+    # Scanner identification and tissue from center pixel of pooled patches
+    center = pool[:, 4, 4, 0]
+    assert np.all(scanner[:, 0] == (center >= 10))
+    assert np.all(scanner[:6, 0] == 0)
+    assert np.all(scanner[6:, 0] == 1)
+    tissue = center % 10
+
+    # Pairs are similar exactly if both patches are of the same tissue
+    same = tissue[combs[:, 0]] == tissue[combs[:, 1]]
+    assert np.all(S[:, 0] == same)
+    assert np.any(S == 0) and np.any(S == 1)
+
+
+def test_iter_pair_batches():
+    """Batches split pairs of each pool into steps of batch_size."""
+    N = MRAIConvolutionalNeuralNetwork(patch_size=(9, 9),
+                                       num_kernels=[1],
+                                       kernel_size=[(2, 2)],
+                                       dense_size=[2],
+                                       num_draw=2,
+                                       batch_size=8)
+    Y = np.round(np.linspace(0, 3, 32**2)).reshape((32, 32))
+    y = N.class_index(Y, edge=(4, 4))
+    X = rn.randn(2, 32, 32).astype('float32')
+    Z = rn.randn(1, 32, 32).astype('float32')
+    draws = N.pair_draws(X, np.stack([Y, Y]), Z, Y[None], num_targets=1)
+    batches = list(N.iter_pair_batches(draws))
+
+    # Per source image, one draw with the target and one with other source
+    assert len(draws) == 4
+    num_pairs = [N.sample_pool(X[0], y, Z[0], y, num_draw=(2, 1))[3].shape[0],
+                 N.sample_pool(X[0], y, X[1], y, num_draw=(2, 2))[3].shape[0]]
+    assert num_pairs == [63, 108]
+    assert sum(S.shape[0] for P, S in batches) == 2*sum(num_pairs)
+
+    # Steps per epoch: 63 pairs in 8 batches and 108 pairs in 14 batches
+    assert len(batches) == N.num_pair_batches(draws) == 2*(8 + 14)
+    assert N.pair_dataset(draws).cardinality().numpy() == 44
+
+    for (pool, scanner, iA, iB), S in batches:
+
+        # Shapes and types match the signature of the training dataset
+        assert 0 < S.shape[0] <= N.batch_size
+        assert pool.shape[1:] == (9, 9, 1)
+        assert scanner.shape == (pool.shape[0], 1)
+        assert iA.shape == iB.shape == (S.shape[0],)
+        assert S.shape[1] == 1
+        assert pool.dtype == scanner.dtype == S.dtype == np.float32
+        assert iA.dtype == iB.dtype == np.int32
+
+        # Pairs index into the pool
+        assert np.all((iA >= 0) & (iA < pool.shape[0]))
+        assert np.all((iB >= 0) & (iB < pool.shape[0]))
+
 
 def test_feedforward():
     N = MRAIConvolutionalNeuralNetwork(patch_size=(31, 31))
@@ -130,3 +285,60 @@ def test_feedforward():
     H = N.feedforward(P, scan_ID=0)
     assert H.shape[0] == P.shape[0]
     assert H.shape[1] == 2
+
+
+def test_embed_image():
+    """Fully-convolutional embedding equals feeding every patch."""
+    N = MRAIConvolutionalNeuralNetwork(patch_size=(15, 15),
+                                       num_kernels=[4, 3],
+                                       kernel_size=[(3, 3), (2, 2)])
+    X = rn.randn(34, 30)
+    P = extract_all_patches(X, patch_size=(15, 15), edge=(0, 0), add_4d=True)
+    H = N.embed_image(np.pad(X, pad_width=7, mode='constant'), scan_ID=1)
+    assert H.shape == (34, 30, 2)
+    assert np.allclose(H.reshape((-1, 2)), N.feedforward(P, scan_ID=1),
+                       atol=1e-4)
+
+
+def test_embed_image_pooling(monkeypatch):
+    """Fully-convolutional embedding follows the pooling of the tower."""
+    class MaxPooling3x2(kl.MaxPooling2D):
+        def __init__(self, pool_size=None, **kwargs):
+            super().__init__(pool_size=(3, 2), **kwargs)
+
+    monkeypatch.setattr(kl, 'MaxPooling2D', MaxPooling3x2)
+    N = MRAIConvolutionalNeuralNetwork(patch_size=(15, 15),
+                                       num_kernels=[4, 3],
+                                       kernel_size=[(3, 3), (2, 2)])
+    X = rn.randn(20, 18)
+    P = extract_all_patches(X, patch_size=(15, 15), edge=(0, 0), add_4d=True)
+    H = N.embed_image(np.pad(X, pad_width=7, mode='constant'), scan_ID=0)
+    assert H.shape == (20, 18, 2)
+    assert np.allclose(H.reshape((-1, 2)), N.feedforward(P, scan_ID=0),
+                       atol=1e-4)
+
+
+def test_segment_image_nofeed():
+    """Raw patches are classified around every pixel."""
+    class CenterPixel(object):
+        def predict(self, P):
+            return P[:, 2, 3]
+
+    N = MRAIConvolutionalNeuralNetwork(patch_size=(5, 7))
+    X = rn.randn(12, 10)
+    assert np.all(N.segment_image(X, CenterPixel(), feed=False) == X)
+
+
+def test_mixed_precision():
+    """Mixed precision scales the loss and embeds as in float32."""
+    N = MRAIConvolutionalNeuralNetwork(patch_size=(15, 15),
+                                       num_kernels=[4, 3],
+                                       kernel_size=[(3, 3), (2, 2)],
+                                       mixed_precision=True)
+    assert isinstance(N.net.optimizer, kmp.LossScaleOptimizer)
+    X = rn.randn(20, 18)
+    P = extract_all_patches(X, patch_size=(15, 15), edge=(0, 0), add_4d=True)
+    H = N.embed_image(np.pad(X, pad_width=7, mode='constant'), scan_ID=1)
+    assert H.shape == (20, 18, 2)
+    assert np.allclose(H.reshape((-1, 2)), N.feedforward(P, scan_ID=1),
+                       rtol=1e-2, atol=1e-2)
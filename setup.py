@@ -29,6 +29,7 @@ setup(
                  'License :: OSI Approved :: MIT License',
                  'Development Status :: 3 - Alpha',
                  'Operating System :: POSIX :: Linux',
-                 'Programming Language :: Python :: 3.5',
-                 'Programming Language :: Python :: 3.6']
+                 'Programming Language :: Python :: 3.7',
+                 'Programming Language :: Python :: 3.8',
+                 'Programming Language :: Python :: 3.9']
 )